@@ -1,25 +1,43 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Any
+from typing import List
 from dotenv import load_dotenv
-from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
-from langchain_openai import ChatOpenAI
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_qdrant import QdrantVectorStore
-from langgraph.graph.state import StateGraph
-from qdrant_client import QdrantClient
-from typing import TypedDict
-import json
+from rag_core import (
+    CASUAL_RESPONSES,
+    EMBEDDING_CACHE_PATH,
+    build_graph,
+    invalidate_caches,
+    warm_mmr_select,
+    query_cache,
+)
+import contextlib
+import queue
+import secrets
+import logging
+import logging.handlers
+import orjson
 import asyncio
 import os
 
 load_dotenv()
 
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that enqueues the raw record; the stock prepare() formats it in the calling thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+# Log records are handed to a background thread, which does the formatting and stdout writes
+log_queue: queue.Queue = queue.Queue()
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+logger = logging.getLogger("rag")
+logger.addHandler(DeferredQueueHandler(log_queue))
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+logger.propagate = False
+
 app = FastAPI(title="RAG API", description="RAG System API")
 
 app.add_middleware(
@@ -44,225 +62,174 @@ class FeedbackRequest(BaseModel):
     answer: str
     positive: bool
 
-TOGETHER_key = os.getenv("TOGETHER_API_KEY")
-TOGETHER_base = os.getenv("TOGETHER_API_BASE")
-
-os.environ["OPENAI_API_KEY"] = TOGETHER_key
-os.environ["OPENAI_API_BASE"] = TOGETHER_base
-
-try:
-    print("Connecting to Qdrant...")
-    qdrant = QdrantClient(host="localhost", port=6333)
-    collections = qdrant.get_collections()
-    print(f"Qdrant collections: {collections}")
-
-    embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    vectorstore = QdrantVectorStore(
-        client=qdrant,
-        collection_name="website_rag",
-        embedding=embedding_model,
-        content_payload_key="page_content"
-    )
-
-    retriever = vectorstore.as_retriever()
+def ndjson(message: dict) -> bytes:
+    """Serialize one streaming message as a newline-terminated JSON line"""
+    return orjson.dumps(message) + b"\n"
 
-    print("Setting up LLM...")
-    prompt_template = PromptTemplate(
-        input_variables=["context", "memoryContext", "input"],
-        template="""
-You are ComAI, a helpful and friendly assistant for Commedia Solutions. 
-Answer the question using only the context below. Be casual and clear.
+STREAM_CHUNK_SIZE = 32
 
-Context:
-{context}
+def token_chunks(text: str) -> List[bytes]:
+    """Split text into token messages of STREAM_CHUNK_SIZE characters"""
+    return [
+        ndjson({"type": "token", "content": text[i:i + STREAM_CHUNK_SIZE]})
+        for i in range(0, len(text), STREAM_CHUNK_SIZE)
+    ]
 
-Conversation History:
-{memoryContext}
-
-Question: {input}
-Answer:"""
-    )
+# Casual replies never change, so serialize their stream messages once
+CASUAL_STREAMS = {
+    question: token_chunks(reply) + [ndjson({"type": "done"})]
+    for question, reply in CASUAL_RESPONSES.items()
+}
 
-    # Follow-up questions prompt template
-    followup_prompt = PromptTemplate(
-        input_variables=["question", "answer"],
-        template="""
-Based on the original question and answer about Commedia Solutions, generate 3 relevant follow-up questions that a user might naturally ask next. 
-Make them specific, business-relevant, and focused on Commedia Solutions services or information.
+graph = embedding_model = retriever = llm = None
 
-Original Question: {question}
-Answer: {answer}
-
-Generate exactly 3 follow-up questions as a JSON array. Example format:
-["What services does Commedia provide?", "How can I contact Commedia?", "What industries does Commedia serve?"]
+@app.on_event("startup")
+async def init_rag():
+    """Build the RAG graph in each serving process, not at import (the multi-worker supervisor never serves)"""
+    global graph, embedding_model, retriever, llm
+    try:
+        graph, embedding_model, retriever, llm = await asyncio.to_thread(build_graph)
+    except Exception as e:
+        logger.exception("Fatal RAG startup error: %s", e)
+
+WARMUP_STEP_TIMEOUT = 15
+warmup_task: asyncio.Task | None = None
+
+async def warmup():
+    """Load model weights and open Qdrant/LLM connections before the first user request"""
+    steps = [
+        ("embedding", embedding_model.embed_query, "warmup"),
+        ("rerank", warm_mmr_select),
+        ("retriever", retriever.invoke, "warmup"),
+        ("llm", llm.invoke, 'Reply with {"ok": true} as JSON.'),
+    ]
+    for name, fn, *args in steps:
+        try:
+            # A hung backend only delays its own step, never server start
+            await asyncio.wait_for(asyncio.to_thread(fn, *args), WARMUP_STEP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Warmup %s timed out after %ss", name, WARMUP_STEP_TIMEOUT)
+        except Exception as e:
+            logger.warning("Warmup %s error: %s", name, e)
+
+@app.on_event("startup")
+async def start_warmup():
+    global warmup_task
+    if graph is not None:
+        warmup_task = asyncio.create_task(warmup())
+
+@app.on_event("shutdown")
+def save_embedding_cache():
+    if embedding_model is None:
+        return
+    try:
+        embedding_model.save(EMBEDDING_CACHE_PATH)
+    except Exception as e:
+        logger.warning("Embedding cache save error: %s", e)
 
-Follow-up Questions:"""
-    )
+@app.get("/")
+def read_root():
+    return {"message": "RAG API is running", "status": "healthy"}
 
-    llm = ChatOpenAI(
-        model="mistralai/Mixtral-8x7B-Instruct-v0.1",
-        temperature=0.2,
-        top_p=0.95
-    )
+@app.get("/health")
+def health_check():
+    return {"status": "healthy", "rag_initialized": graph is not None}
 
-    # Separate LLM instance for follow-up generation (higher temperature for creativity)
-    followup_llm = ChatOpenAI(
-        model="mistralai/Mixtral-8x7B-Instruct-v0.1",
-        temperature=0.2,
-        top_p=0.95
-    )
+@app.get("/cache/stats")
+def cache_stats():
+    # Caches are per worker process; these numbers describe only the worker that answered
+    return {"worker_pid": os.getpid(), **query_cache.stats()}
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(token: str | None) -> None:
+    """Reject admin calls unless ADMIN_TOKEN is configured and matches the X-Admin-Token header"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+    if token is None or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.post("/cache/clear")
+def cache_clear(x_admin_token: str | None = Header(default=None)):
+    require_admin(x_admin_token)
+    # Call after re-ingesting documents into Qdrant so stale answers are dropped;
+    # the other workers pick up the invalidation on their next query
+    invalidate_caches()
+    return {"status": "success"}
 
-    # Create custom RAG chain that supports memoryContext
-    document_chain = create_stuff_documents_chain(llm, prompt_template)
-    rag_chain = create_retrieval_chain(retriever, document_chain)
+FEEDBACK_LOG_PATH = "feedback_log.jsonl"
+FEEDBACK_BATCH_SIZE = 50
+FEEDBACK_FLUSH_SECONDS = 1.0
 
-    class RagState(TypedDict):
-        question: str
-        answer: str
-        sources: List[Any]
-        follow_ups: List[str]
-        memoryContext: str
+feedback_queue: asyncio.Queue[str] = asyncio.Queue()
+feedback_writer_task: asyncio.Task | None = None
 
-    def generate_followup_questions(question: str, answer: str) -> List[str]:
-        """Generate follow-up questions using LLM"""
+def append_feedback(lines: List[str]) -> None:
+    """Append feedback records to the JSONL log (blocking)"""
+    # One O_APPEND write per batch so records from several workers never interleave
+    data = "".join(line + "\n" for line in lines).encode()
+    fd = os.open(FEEDBACK_LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+async def feedback_writer():
+    """Write queued feedback in batches of up to 50 records or every second"""
+    loop = asyncio.get_running_loop()
+    while True:
+        lines = [await feedback_queue.get()]
+        deadline = loop.time() + FEEDBACK_FLUSH_SECONDS
         try:
-            
-            casual_keywords = ["thanks", "thank you", "hi", "hello", "hey", "okay", "ok"]
-            if any(keyword in question.lower() for keyword in casual_keywords):
-                return []
-            
-            prompt = followup_prompt.format(question=question, answer=answer)
-            response = followup_llm.invoke(prompt)
-
-            # Parse JSON response
+            while len(lines) < FEEDBACK_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    lines.append(await asyncio.wait_for(feedback_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Shutting down mid-batch; don't drop what we already pulled off the queue
             try:
-                import re
-                # Extract JSON array from response
-                json_match = re.search(r'\[.*?\]', response.content, re.DOTALL)
-                if json_match:
-                    follow_ups = json.loads(json_match.group())
-                    # Ensure we have exactly 3 questions and they're strings
-                    if isinstance(follow_ups, list) and len(follow_ups) >= 3:
-                        return [str(q) for q in follow_ups[:3]]
-            except:
-                pass
-            
-            # Fallback to predefined follow-ups
-            return get_fallback_followups(question, answer)
-            
+                append_feedback(lines)
+            except Exception as e:
+                logger.error("Feedback write error: %s", e)
+            raise
+        try:
+            await asyncio.to_thread(append_feedback, lines)
         except Exception as e:
-            print(f"Error generating follow-ups: {e}")
-            return get_fallback_followups(question, answer)
-
-    def get_fallback_followups(question: str, answer: str) -> List[str]:
-        """Fallback follow-up questions based on keywords"""
-        question_lower = question.lower()
-        
-        if "service" in question_lower or "what does" in question_lower:
-            return [
-                "How can I contact Commedia Solutions?",
-                "What industries does Commedia serve?",
-                "Can you tell me more about Commedia's experience?"
-            ]
-        elif "contact" in question_lower or "reach" in question_lower:
-            return [
-                "What services does Commedia provide?",
-                "What are Commedia's business hours?",
-                "Does Commedia offer consultations?"
-            ]
-        elif "price" in question_lower or "cost" in question_lower:
-            return [
-                "What services are included in Commedia's packages?",
-                "How can I get a quote from Commedia?",
-                "Does Commedia offer custom solutions?"
-            ]
-        else:
-            return [
-                "What services does Commedia Solutions provide?",
-                "How can I contact Commedia Solutions?",
-                "Can you tell me more about Commedia's expertise?"
-            ]
-
-    def rag_node(state: RagState) -> RagState:
-        query = state["question"]
-        memory_context = state.get("memoryContext", "")
-        print(f"Processing query: {query}")
-        print(f"Memory context: {memory_context}")
+            logger.error("Feedback write error: %s", e)
+
+@app.on_event("startup")
+async def start_feedback_writer():
+    global feedback_writer_task
+    feedback_writer_task = asyncio.create_task(feedback_writer())
+
+@app.on_event("shutdown")
+async def flush_feedback():
+    if feedback_writer_task is not None:
+        feedback_writer_task.cancel()
+        # Let the writer flush the batch it already pulled while logging is still up
+        with contextlib.suppress(asyncio.CancelledError):
+            await feedback_writer_task
+    lines = []
+    while not feedback_queue.empty():
+        lines.append(feedback_queue.get_nowait())
+    if lines:
         try:
-            # Use the custom RAG chain that supports memoryContext
-            chain_input = {
-                "input": query,  # New chain expects "input" not "query"
-                "memoryContext": memory_context
-            }
-            print(f"Chain input: {chain_input}")
-            
-            result = rag_chain.invoke(chain_input)
-
-            answer = result.get("answer", "Sorry, I couldn't find anything.")
-            sources = []
-            seen = set()
-            
-            # Extract sources from context documents
-            for doc in result.get("context", []):
-                src = doc.metadata.get("source", "unknown")
-                if src not in seen:
-                    seen.add(src)
-                    sources.append(src)
-
-            # Generate follow-up questions
-            follow_ups = generate_followup_questions(query, answer)
-
-            return {
-                "question": query,
-                "answer": answer,
-                "sources": sources,
-                "follow_ups": follow_ups,
-                "memoryContext": memory_context
-            }
-
+            append_feedback(lines)
         except Exception as e:
-            print(f"Error in rag_node: {e}")
-            import traceback
-            traceback.print_exc()
-            return {
-                "question": query,
-                "answer": "Oops! Something went wrong. Try again later.",
-                "sources": [],
-                "follow_ups": [],
-                "memoryContext": memory_context
-            }
-
-    builder = StateGraph(RagState)
-    builder.add_node("rag_chain", rag_node)
-    builder.set_entry_point("rag_chain")
-    builder.set_finish_point("rag_chain")
-    graph = builder.compile()
-    print("RAG system initialized successfully!")
-
-except Exception as e:
-    print(f"Fatal RAG startup error: {e}")
-    graph = None
-
-@app.get("/")
-def read_root():
-    return {"message": "RAG API is running", "status": "healthy"}
-
-@app.get("/health")
-def health_check():
-    return {"status": "healthy", "rag_initialized": graph is not None}
+            logger.error("Feedback write error: %s", e)
 
 @app.post("/feedback")
 async def receive_feedback(feedback: FeedbackRequest):
-    try:
-        with open("feedback_log.jsonl", "a") as f:
-            f.write(feedback.json() + "\n")
-    except Exception as e:
-        print(f"Feedback write error: {e}")
+    await feedback_queue.put(feedback.json())
     return {"status": "success"}
 
 @app.post("/query", response_model=QueryResponse)
 async def query_rag(request: QueryRequest):
-    print(f"Received query: {request.question}")
+    logger.info("Received query: %s", request.question)
     if not graph:
         raise HTTPException(status_code=500, detail="RAG system not initialized")
 
@@ -270,18 +237,8 @@ async def query_rag(request: QueryRequest):
         raise HTTPException(status_code=400, detail="Question cannot be empty")
 
     lower_q = request.question.strip().lower()
-    casual = {
-        "okay": "Okay! Let me know if you need anything else.",
-        "ok": "Okay! Let me know if you need anything else.",
-        "thanks": "You're very welcome!",
-        "thank you": "Happy to help!",
-        "hi": "Hey there! What would you like to know about Commedia?",
-        "hello": "Hello! Ask me anything about Commedia Solutions.",
-        "hey": "Hey there! What would you like to know about Commedia?"
-    }
-
-    if lower_q in casual:
-        return QueryResponse(answer=casual[lower_q], sources=[], follow_ups=[])
+    if lower_q in CASUAL_RESPONSES:
+        return QueryResponse(answer=CASUAL_RESPONSES[lower_q], sources=[], follow_ups=[])
 
     # Fixed: Simplified memoryContext handling
     state = {
@@ -292,7 +249,7 @@ async def query_rag(request: QueryRequest):
         "memoryContext": request.memoryContext or "",
     }
 
-    result = graph.invoke(state)
+    result = await graph.ainvoke(state)
     return QueryResponse(
         answer=result["answer"], 
         sources=result["sources"],
@@ -301,36 +258,22 @@ async def query_rag(request: QueryRequest):
 
 @app.post("/query-stream")
 async def query_rag_stream(request: QueryRequest):
-    print(f"Received streaming query: {request.question}")
+    logger.info("Received streaming query: %s", request.question)
     
     async def generate():
         if not graph:
-            yield json.dumps({"type": "error", "content": "RAG system not initialized"}) + "\n"
+            yield ndjson({"type": "error", "content": "RAG system not initialized"})
             return
         
         if not request.question.strip():
-            yield json.dumps({"type": "error", "content": "Question cannot be empty"}) + "\n"
+            yield ndjson({"type": "error", "content": "Question cannot be empty"})
             return
         
         # Handle casual responses
         lower_q = request.question.strip().lower()
-        casual = {
-            "okay": "Okay! Let me know if you need anything else.",
-            "ok": "Okay! Let me know if you need anything else.",
-            "thanks": "You're very welcome!",
-            "thank you": "Happy to help!",
-            "hi": "Hey there! What would you like to know about Commedia?",
-            "hello": "Hello! Ask me anything about Commedia Solutions.",
-            "hey": "Hey there! What would you like to know about Commedia?"
-        }
-        
-        if lower_q in casual:
-            # Stream the casual response
-            response = casual[lower_q]
-            for char in response:
-                yield json.dumps({"type": "token", "content": char}) + "\n"
-                await asyncio.sleep(0.000002)  # Much faster streaming
-            yield json.dumps({"type": "done"}) + "\n"
+        if lower_q in CASUAL_STREAMS:
+            for chunk in CASUAL_STREAMS[lower_q]:
+                yield chunk
             return
         
         # Process with RAG
@@ -344,29 +287,48 @@ async def query_rag_stream(request: QueryRequest):
         }
         
         try:
-            result = graph.invoke(state)
+            result = await graph.ainvoke(state)
             answer = result["answer"]
             sources = result["sources"]
             follow_ups = result["follow_ups"]
             
-            # Stream the answer token by token
-            for char in answer:
-                yield json.dumps({"type": "token", "content": char}) + "\n"
-                await asyncio.sleep(0.002)  # Much faster streaming
+            # Stream the answer in small chunks
+            for chunk in token_chunks(answer):
+                yield chunk
             
             # Send sources
             if sources:
-                yield json.dumps({"type": "sources", "content": sources}) + "\n"
+                yield ndjson({"type": "sources", "content": sources})
             
             # Send follow-up questions
             if follow_ups:
-                yield json.dumps({"type": "follow_ups", "content": follow_ups}) + "\n"
+                yield ndjson({"type": "follow_ups", "content": follow_ups})
             
             # Send completion signal
-            yield json.dumps({"type": "done"}) + "\n"
+            yield ndjson({"type": "done"})
             
         except Exception as e:
-            print(f"Streaming error: {e}")
-            yield json.dumps({"type": "error", "content": "Something went wrong. Please try again."}) + "\n"
+            logger.exception("Streaming error: %s", e)
+            yield ndjson({"type": "error", "content": "Something went wrong. Please try again."})
     
-    return StreamingResponse(generate(), media_type="text/plain")
\ No newline at end of file
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# Registered last so the other shutdown handlers can still log
+@app.on_event("shutdown")
+def stop_log_listener():
+    log_listener.stop()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Workers read this back to size their inference thread pools
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "api_server:app",
+        host="0.0.0.0",
+        port=8010,
+        loop="uvloop",
+        http="httptools",
+        workers=workers
+    )
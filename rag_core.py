@@ -0,0 +1,712 @@
+from typing import List, Any
+from dotenv import load_dotenv
+from langchain.prompts import PromptTemplate
+from langchain.chains import create_retrieval_chain
+from langchain_openai import ChatOpenAI
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnablePassthrough
+from langchain_huggingface import HuggingFaceEmbeddings
+from langgraph.graph.state import StateGraph
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+)
+from typing import TypedDict
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    # Numba is optional; without it mmr_select runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import lru_cache
+import httpx
+import numpy as np
+import hashlib
+import pickle
+import shutil
+import tempfile
+import queue
+import threading
+import time
+import logging
+import orjson
+import asyncio
+import os
+
+load_dotenv()
+
+logger = logging.getLogger("rag")
+
+class QueryCache:
+    """Thread-safe LRU cache with TTL for full RAG responses"""
+
+    def __init__(self, max_size: int = 2000, ttl_seconds: float = 600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(question: str, memory_context: str | None) -> str:
+        raw = question.strip().lower().encode() + b"|" + (memory_context or "").encode()
+        return hashlib.blake2b(raw).hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+query_cache = QueryCache(max_size=2000, ttl_seconds=600)
+
+CASUAL_RESPONSES = {
+    "okay": "Okay! Let me know if you need anything else.",
+    "ok": "Okay! Let me know if you need anything else.",
+    "thanks": "You're very welcome!",
+    "thank you": "Happy to help!",
+    "hi": "Hey there! What would you like to know about Commedia?",
+    "hello": "Hello! Ask me anything about Commedia Solutions.",
+    "hey": "Hey there! What would you like to know about Commedia?"
+}
+CASUAL_KEYWORDS = frozenset(CASUAL_RESPONSES)
+
+class CachedEmbeddings(Embeddings):
+    """LRU cache in front of an embedding model so repeated texts skip the forward pass"""
+
+    def __init__(self, model: Embeddings, model_id: str, max_size: int = 4096):
+        self.model = model
+        # Identifies the backend that produced the vectors so a saved cache is never reused across models
+        self.model_id = model_id
+        self.max_size = max_size
+        self._data: OrderedDict[str, List[float]] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _get(self, text: str) -> List[float] | None:
+        with self._lock:
+            vector = self._data.get(text)
+            if vector is not None:
+                self._data.move_to_end(text)
+            return vector
+
+    def _set(self, text: str, vector: List[float]) -> None:
+        with self._lock:
+            self._data[text] = vector
+            self._data.move_to_end(text)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._get(text)
+        if vector is None:
+            vector = self.model.embed_query(text)
+            self._set(text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector = self._get(text)
+        if vector is None:
+            vector = await self.model.aembed_query(text)
+            self._set(text, vector)
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Only run the model on unique texts we haven't seen before
+        missing = [t for t in dict.fromkeys(texts) if self._get(t) is None]
+        if missing:
+            for text, vector in zip(missing, self.model.embed_documents(missing)):
+                self._set(text, vector)
+        return [self._get(t) or self.embed_query(t) for t in texts]
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            items = list(self._data.items())
+        # Several workers save on shutdown at once; write privately and swap in atomically
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"model_id": self.model_id, "items": items}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        if not isinstance(saved, dict) or saved.get("model_id") != self.model_id:
+            logger.info("Ignoring embedding cache saved for a different model")
+            return
+        for text, vector in saved["items"][-self.max_size:]:
+            self._set(text, vector)
+
+def inference_threads() -> int:
+    """Per-worker thread budget for embedding inference, so N workers don't each use every core"""
+    if os.getenv("INFERENCE_THREADS"):
+        return max(1, int(os.getenv("INFERENCE_THREADS")))
+    cpus = os.cpu_count() or 1
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    return max(1, cpus // max(1, workers))
+
+class OnnxBatchedEmbeddings(Embeddings):
+    """MiniLM served through ONNX Runtime, with concurrent queries grouped into one batch"""
+
+    def __init__(self, model_name: str, export_dir: str = "onnx_mini",
+                 max_batch: int = 32, max_wait_ms: float = 5, quantize: bool = True):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        available = onnxruntime.get_available_providers()
+        provider = "CUDAExecutionProvider" if "CUDAExecutionProvider" in available else "CPUExecutionProvider"
+
+        if not os.path.isdir(export_dir):
+            # Export into a private temp dir and rename it into place, so a crash or a
+            # concurrently starting worker never leaves a half-written export_dir behind
+            parent = os.path.dirname(os.path.abspath(export_dir))
+            tmp_dir = tempfile.mkdtemp(prefix=".onnx-export-", dir=parent)
+            try:
+                exported = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+                exported.save_pretrained(tmp_dir)
+                AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_dir)
+                if quantize:
+                    # Dynamic INT8 weights; writes model_quantized.onnx next to model.onnx
+                    quantizer = ORTQuantizer.from_pretrained(exported)
+                    quantizer.quantize(
+                        save_dir=tmp_dir,
+                        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                    )
+                try:
+                    os.rename(tmp_dir, export_dir)
+                except OSError:
+                    # Another worker finished its export first; use that one
+                    pass
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # INT8 kernels only pay off on CPU; CUDA keeps the FP32 graph
+        file_name = "model.onnx"
+        if quantize and provider == "CPUExecutionProvider" and os.path.exists(os.path.join(export_dir, "model_quantized.onnx")):
+            file_name = "model_quantized.onnx"
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = inference_threads()
+        session_options.inter_op_num_threads = 1
+
+        # IO binding (on by default for CUDA) rejects the numpy inputs _encode feeds in
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            export_dir, file_name=file_name, provider=provider, use_io_binding=False,
+            session_options=session_options
+        )
+        self.model_id = f"onnx:{model_name}:{file_name}"
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        # Fail here rather than on the first query, so load_base_embeddings can fall back to HF
+        self._encode(["warmup"])
+
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: queue.Queue[tuple[str, Future]] = queue.Queue()
+        threading.Thread(target=self._batch_worker, daemon=True).start()
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=256, return_tensors="np")
+        hidden = self.model(**inputs).last_hidden_state
+        # Mean pooling + L2 normalisation, same as the sentence-transformers pipeline
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def _batch_worker(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                vectors = self._encode([text for text, _ in batch])
+                for (_, future), vector in zip(batch, vectors):
+                    future.set_result(vector.tolist())
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def _submit(self, text: str) -> Future:
+        future: Future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._submit(text).result()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self._submit(text))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for i in range(0, len(texts), self.max_batch):
+            vectors.extend(self._encode(texts[i:i + self.max_batch]).tolist())
+        return vectors
+
+class PrefillLimiter:
+    """Stream LLM calls so that at most max_prefill per worker are waiting for their first token"""
+
+    def __init__(self, llm: Any, max_prefill: int = 1):
+        self.llm = llm
+        self._prefill = asyncio.Semaphore(max_prefill)
+
+    async def ainvoke(self, prompt: Any, config: RunnableConfig | None = None) -> BaseMessage:
+        await self._prefill.acquire()
+        released = False
+        message = None
+        try:
+            async for chunk in self.llm.astream(prompt, config=config):
+                if not released:
+                    # First token is in, so the next queued call can start its prefill
+                    self._prefill.release()
+                    released = True
+                message = chunk if message is None else message + chunk
+        finally:
+            if not released:
+                self._prefill.release()
+        return message if message is not None else AIMessage(content="")
+
+def load_base_embeddings(model_name: str) -> tuple[Embeddings, str]:
+    """ONNX Runtime embedder when optimum is installed, HuggingFace otherwise; returns (embedder, model_id)"""
+    if os.getenv("EMBEDDING_BACKEND", "onnx") == "onnx":
+        try:
+            embedder = OnnxBatchedEmbeddings(model_name)
+            return embedder, embedder.model_id
+        except ImportError as e:
+            logger.warning("ONNX embeddings unavailable (%s), falling back to HuggingFace", e)
+        except Exception as e:
+            logger.exception("ONNX embeddings failed to load (%s), falling back to HuggingFace", e)
+    import torch
+
+    torch.set_num_threads(inference_threads())
+    return HuggingFaceEmbeddings(model_name=model_name), f"hf:{model_name}"
+
+EMBEDDING_CACHE_PATH = "embedding_cache.pkl"
+MAX_DOC_CHARS = 800
+
+SYSTEM_PREAMBLE = """You are ComAI, a helpful and friendly assistant for Commedia Solutions. 
+Answer the question using only the context below. Be casual and clear.
+Also suggest 3 specific, business-relevant follow-up questions the user might naturally ask next about Commedia Solutions."""
+
+DOCUMENT_SEPARATOR = "\n---\n"
+# Joined context strings keyed on the retrieved Qdrant point IDs
+context_cache = QueryCache(max_size=1024, ttl_seconds=600)
+
+# Each worker process has its own caches; clearing bumps the mtime of this
+# shared marker file and every worker drops its caches when it sees the change
+CACHE_GENERATION_PATH = "cache_generation"
+_seen_generation = 0
+
+def _read_cache_generation() -> int:
+    try:
+        return os.stat(CACHE_GENERATION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def sync_cache_generation() -> None:
+    """Clear this worker's caches if another worker invalidated them"""
+    global _seen_generation
+    generation = _read_cache_generation()
+    if generation != _seen_generation:
+        _seen_generation = generation
+        query_cache.clear()
+        context_cache.clear()
+
+def invalidate_caches() -> None:
+    """Clear the response and context caches in every worker"""
+    now = time.time_ns()
+    with open(CACHE_GENERATION_PATH, "a"):
+        pass
+    os.utime(CACHE_GENERATION_PATH, ns=(now, now))
+    sync_cache_generation()
+
+def stuff_documents(docs: List[Document]) -> str:
+    """Join retrieved documents into the prompt context, reusing the result for a repeated set"""
+    ids = [doc.metadata.get("_id") for doc in docs]
+    if not docs or None in ids:
+        return DOCUMENT_SEPARATOR.join(doc.page_content for doc in docs)
+
+    key = "|".join(str(i) for i in ids)
+    cached = context_cache.get(key)
+    if cached is not None:
+        return cached["text"]
+    text = DOCUMENT_SEPARATOR.join(doc.page_content for doc in docs)
+    context_cache.set(key, {"text": text})
+    return text
+
+RERANK_FETCH_K = 20
+RERANK_TOP_K = 3
+RERANK_LAMBDA = 0.5
+
+@njit(cache=True)
+def mmr_select(scores: np.ndarray, sims: np.ndarray, lam: float, k: int) -> np.ndarray:
+    """Greedy maximal marginal relevance over candidate scores and pairwise similarities"""
+    n = scores.shape[0]
+    k = min(k, n)
+    selected = np.empty(k, dtype=np.int64)
+    chosen = np.zeros(n, dtype=np.bool_)
+    max_sim = np.zeros(n, dtype=np.float32)
+    for step in range(k):
+        best = -1
+        best_value = 0.0
+        for i in range(n):
+            if chosen[i]:
+                continue
+            value = scores[i]
+            if step > 0:
+                value = lam * scores[i] - (1.0 - lam) * max_sim[i]
+            # Seed from the first unchosen candidate so best is always a real index
+            if best == -1 or value > best_value:
+                best_value = value
+                best = i
+        selected[step] = best
+        chosen[best] = True
+        for i in range(n):
+            if step == 0 or sims[i, best] > max_sim[i]:
+                max_sim[i] = sims[i, best]
+    return selected
+
+def rerank_points(points: List[Any]) -> List[Document]:
+    """MMR-rerank Qdrant candidates using their stored vectors and convert the top ones to Documents"""
+    if not points:
+        return []
+
+    scores = np.array([p.score for p in points], dtype=np.float32)
+    vectors = np.array([p.vector for p in points], dtype=np.float32)
+    vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+    order = mmr_select(scores, vectors @ vectors.T, RERANK_LAMBDA, RERANK_TOP_K)
+
+    docs = []
+    for i in order:
+        payload = points[i].payload or {}
+        metadata = dict(payload.get("metadata") or {})
+        metadata.update({"_id": points[i].id, "_collection_name": "website_rag"})
+        docs.append(Document(page_content=payload.get("page_content", ""), metadata=metadata))
+    return docs
+
+def warm_mmr_select() -> None:
+    """Trigger the Numba compile with the same argument types retrieval uses"""
+    if not NUMBA_AVAILABLE:
+        logger.warning("Numba unavailable, MMR reranking runs as plain Python")
+    mmr_select(np.zeros(2, dtype=np.float32), np.eye(2, dtype=np.float32), RERANK_LAMBDA, RERANK_TOP_K)
+
+def truncate_documents(docs: List[Document]) -> List[Document]:
+    """Cap each retrieved document so the stuffed prompt stays short"""
+    return [
+        Document(page_content=doc.page_content[:MAX_DOC_CHARS], metadata=doc.metadata)
+        for doc in docs
+    ]
+
+def apply_quantization(client: QdrantClient, collection_name: str, mode: str) -> bool:
+    """Enable vector quantization on the collection (admin step, not run by the server); returns whether it changed"""
+    if mode == "binary":
+        config = BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    elif mode == "scalar":
+        config = ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True))
+    else:
+        return False
+
+    if client.get_collection(collection_name).config.quantization_config == config:
+        return False
+    client.update_collection(collection_name, quantization_config=config)
+    return True
+
+def quantization_search_params(client: QdrantClient, collection_name: str) -> SearchParams | None:
+    """Search params for a quantized collection, or None; only reads the collection config"""
+    if client.get_collection(collection_name).config.quantization_config is None:
+        return None
+    # Search the compressed vectors, then rescore the oversampled candidates with the originals
+    return SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=2.0))
+
+class RagState(TypedDict):
+    question: str
+    answer: str
+    sources: List[Any]
+    follow_ups: List[str]
+    memoryContext: str
+
+def get_fallback_followups(question: str, answer: str) -> List[str]:
+    """Fallback follow-up questions based on keywords"""
+    question_lower = question.lower()
+    
+    if "service" in question_lower or "what does" in question_lower:
+        return [
+            "How can I contact Commedia Solutions?",
+            "What industries does Commedia serve?",
+            "Can you tell me more about Commedia's experience?"
+        ]
+    elif "contact" in question_lower or "reach" in question_lower:
+        return [
+            "What services does Commedia provide?",
+            "What are Commedia's business hours?",
+            "Does Commedia offer consultations?"
+        ]
+    elif "price" in question_lower or "cost" in question_lower:
+        return [
+            "What services are included in Commedia's packages?",
+            "How can I get a quote from Commedia?",
+            "Does Commedia offer custom solutions?"
+        ]
+    else:
+        return [
+            "What services does Commedia Solutions provide?",
+            "How can I contact Commedia Solutions?",
+            "Can you tell me more about Commedia's expertise?"
+        ]
+
+PARSE_FAILURE_ANSWER = "Sorry, I couldn't put an answer together. Please try again."
+
+def parse_structured_answer(raw: str, question: str) -> tuple[str, List[str], bool]:
+    """Split the model's JSON output into the answer and follow-up questions; the flag is False when parsing failed"""
+    try:
+        data = orjson.loads(raw)
+        answer = data["answer"]
+    except Exception:
+        answer = None
+
+    if not isinstance(answer, str) or not answer.strip():
+        # Plain prose is still a usable answer; broken or truncated JSON is never shown
+        text = raw.strip()
+        if not text or text.startswith(("{", "[")):
+            text = PARSE_FAILURE_ANSWER
+        return text, get_fallback_followups(question, text), False
+
+    follow_ups = data.get("follow_ups")
+    if isinstance(follow_ups, list) and len(follow_ups) >= 3:
+        follow_ups = [str(q) for q in follow_ups[:3]]
+    else:
+        follow_ups = get_fallback_followups(question, answer)
+    return answer, follow_ups, True
+
+@lru_cache(maxsize=1)
+def build_graph():
+    """Build the RAG graph once per process; returns (graph, embedding_model, retriever, llm)"""
+    os.environ["OPENAI_API_KEY"] = os.getenv("TOGETHER_API_KEY")
+    os.environ["OPENAI_API_BASE"] = os.getenv("TOGETHER_API_BASE")
+
+    logger.info("Connecting to Qdrant...")
+    # gRPC transport avoids REST + JSON overhead on every retrieval
+    qdrant = QdrantClient(host="localhost", port=6333, grpc_port=6334, prefer_grpc=True)
+    collections = qdrant.get_collections()
+    logger.info("Qdrant collections: %s", collections)
+
+    embedding_model = CachedEmbeddings(
+        *load_base_embeddings("sentence-transformers/all-MiniLM-L6-v2")
+    )
+    try:
+        embedding_model.load(EMBEDDING_CACHE_PATH)
+    except Exception as e:
+        logger.warning("Embedding cache load error: %s", e)
+    try:
+        search_params = quantization_search_params(qdrant, "website_rag")
+    except Exception as e:
+        logger.warning("Qdrant quantization lookup error: %s", e)
+        search_params = None
+
+    search_kwargs = {
+        "limit": RERANK_FETCH_K,
+        "score_threshold": 0.35,
+        "search_params": search_params,
+        "with_payload": True,
+        "with_vectors": True,
+    }
+
+    def retrieve_documents(query: str) -> List[Document]:
+        """Sync retrieval, used by warmup and non-async callers"""
+        points = qdrant.query_points(
+            "website_rag", query=embedding_model.embed_query(query), **search_kwargs
+        ).points
+        return rerank_points(points)
+
+    async_qdrant: AsyncQdrantClient | None = None
+
+    async def aretrieve_documents(query: str) -> List[Document]:
+        """Async retrieval on the event loop; the gRPC client is created on first use inside the loop"""
+        nonlocal async_qdrant
+        if async_qdrant is None:
+            async_qdrant = AsyncQdrantClient(host="localhost", port=6333, grpc_port=6334, prefer_grpc=True)
+        vector = await embedding_model.aembed_query(query)
+        response = await async_qdrant.query_points("website_rag", query=vector, **search_kwargs)
+        # MMR over 20 candidates is microseconds of compiled code, fine to run inline
+        return rerank_points(response.points)
+
+    retriever = RunnableLambda(retrieve_documents, afunc=aretrieve_documents)
+
+    logger.info("Setting up LLM...")
+    prompt_template = PromptTemplate(
+        input_variables=["system_preamble", "context", "memoryContext", "input"],
+        template="""
+{system_preamble}
+
+Context:
+{context}
+
+Conversation History:
+{memoryContext}
+
+Question: {input}
+
+Respond with a single JSON object and nothing else, in this format:
+{{"answer": "your answer here", "follow_ups": ["question 1", "question 2", "question 3"]}}
+"""
+    ).partial(system_preamble=SYSTEM_PREAMBLE)
+
+    # Pooled keep-alive connections so requests to Together.ai skip the TCP/TLS handshake
+    llm_limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200, keepalive_expiry=60)
+
+    # JSON mode so the answer and follow-ups come back from one call
+    llm = ChatOpenAI(
+        model="mistralai/Mixtral-8x7B-Instruct-v0.1",
+        temperature=0.2,
+        top_p=0.95,
+        model_kwargs={"response_format": {"type": "json_object"}},
+        http_client=httpx.Client(limits=llm_limits, timeout=60),
+        http_async_client=httpx.AsyncClient(limits=llm_limits, timeout=60)
+    )
+
+    prefill_limiter = PrefillLimiter(llm, max_prefill=int(os.getenv("LLM_MAX_PREFILL", "1")))
+
+    # Create custom RAG chain that supports memoryContext; documents are
+    # stuffed as bare page_content through the memoized stuff_documents
+    document_chain = (
+        RunnablePassthrough.assign(context=lambda x: stuff_documents(x["context"]))
+        | prompt_template
+        | RunnableLambda(llm.invoke, afunc=prefill_limiter.ainvoke)
+        | StrOutputParser()
+    )
+    # A composed retriever gets the whole chain input, so pick out the question first
+    retrieval = RunnableLambda(lambda x: x["input"]) | retriever | RunnableLambda(truncate_documents)
+    rag_chain = create_retrieval_chain(retrieval, document_chain)
+
+    async def rag_node(state: RagState) -> RagState:
+        query = state["question"]
+        memory_context = state.get("memoryContext", "")
+        logger.info("Processing query: %s", query)
+        logger.debug("Memory context: %s", memory_context)
+
+        sync_cache_generation()
+        cache_key = QueryCache.make_key(query, memory_context)
+        cached = query_cache.get(cache_key)
+        if cached is not None:
+            return {"question": query, **cached, "memoryContext": memory_context}
+
+        try:
+            # Use the custom RAG chain that supports memoryContext
+            chain_input = {
+                "input": query,  # New chain expects "input" not "query"
+                "memoryContext": memory_context
+            }
+            logger.debug("Chain input: %s", chain_input)
+            
+            result = await rag_chain.ainvoke(chain_input)
+
+            answer, follow_ups, parsed = parse_structured_answer(
+                result.get("answer", "Sorry, I couldn't find anything."), query
+            )
+            question_lower = query.lower()
+            if any(keyword in question_lower for keyword in CASUAL_KEYWORDS):
+                follow_ups = []
+            # Unique sources from context documents, in retrieval order
+            sources = list(dict.fromkeys(
+                doc.metadata.get("source", "unknown") for doc in result.get("context", [])
+            ))
+
+            # Don't pin a malformed model response in the cache for the full TTL
+            if parsed:
+                query_cache.set(cache_key, {
+                    "answer": answer,
+                    "sources": sources,
+                    "follow_ups": follow_ups
+                })
+
+            return {
+                "question": query,
+                "answer": answer,
+                "sources": sources,
+                "follow_ups": follow_ups,
+                "memoryContext": memory_context
+            }
+
+        except Exception as e:
+            logger.exception("Error in rag_node: %s", e)
+            return {
+                "question": query,
+                "answer": "Oops! Something went wrong. Try again later.",
+                "sources": [],
+                "follow_ups": [],
+                "memoryContext": memory_context
+            }
+
+    builder = StateGraph(RagState)
+    builder.add_node("rag_chain", rag_node)
+    builder.set_entry_point("rag_chain")
+    builder.set_finish_point("rag_chain")
+    graph = builder.compile()
+    logger.info("RAG system initialized successfully!")
+
+    return graph, embedding_model, retriever, llm
+
+if __name__ == "__main__":
+    import sys
+
+    # Admin/ingest step: python rag_core.py quantize
+    if sys.argv[1:] != ["quantize"]:
+        sys.exit("usage: python rag_core.py quantize")
+    mode = os.getenv("QDRANT_QUANTIZATION", "scalar")
+    client = QdrantClient(host="localhost", port=6333, grpc_port=6334, prefer_grpc=True)
+    changed = apply_quantization(client, "website_rag", mode)
+    print(f"website_rag quantization ({mode}): {'updated' if changed else 'unchanged'}")